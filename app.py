@@ -3,19 +3,44 @@ import json
 import os
 import random
 import requests
+import threading
 import time
 
+from progress_index import ProgressIndex
+from state import SessionStore
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'cthulhu_fhtagn_dev_key')
 
 CHAPTERS_DIR = 'data/chapters'
-# Cache for chapters to avoid re-reading disk too often
+# Cache for chapters to avoid re-reading disk too often.
+# Shared content is copy-on-write: writers build a new dict/list under
+# CONTENT_LOCK and swap the global, readers just take the current reference.
+CONTENT_LOCK = threading.Lock()
 CHAPTER_CACHE = {}
 RANDOM_EVENTS = []
 
-# In-memory storage for Live Mode sessions (simple dict for prototype)
-# Key: session_id (from cookie/secret), Value: list of messages
-LIVE_SESSIONS = {}
+# Story-mode prefetch: responses bundle payloads for successors whose outcome
+# does not depend on dice or random picks, so the client can render them
+# before /choice returns. Limits keep the extra bytes per response bounded.
+PREFETCH_ENABLED = os.environ.get('PREFETCH', '1') != '0'
+PREFETCH_MAX_NODES = 6
+PREFETCH_MAX_BYTES = 16 * 1024
+PREFETCH_STATS = {'responses': 0, 'bundled_nodes': 0, 'bundled_bytes': 0, 'skipped_over_limit': 0,
+                  'response_bytes': 0}
+PREFETCH_STATS_LOCK = threading.Lock()
+
+# Reverse shortest-path distances to the endings, see progress_index.py
+PROGRESS_INDEX = ProgressIndex(warn=app.logger.warning)
+
+# Per-player server-side state (turn counter, Live Mode history), keyed by
+# session['sid']. It lives in this process only. Story state itself is in
+# the signed cookie, so a story session reaching another process (or this
+# one after a restart) is adopted there. Live Mode history cannot move, so
+# live sessions are bound to WORKER_ID. The plain 'worker' cookie lets a
+# proxy route sticky (see README); give each instance its own WORKER_ID.
+SESSIONS = SessionStore()
+WORKER_ID = os.environ.get('WORKER_ID', 'main')
 
 def load_random_events():
     global RANDOM_EVENTS
@@ -23,22 +48,64 @@ def load_random_events():
     if os.path.exists(path):
         with open(path, 'r', encoding='utf-8') as f:
             try:
-                data = json.load(f)
-                RANDOM_EVENTS = data.get('events', [])
+                events = json.load(f).get('events', [])
             except json.JSONDecodeError:
-                RANDOM_EVENTS = []
+                events = []
+        with CONTENT_LOCK:
+            RANDOM_EVENTS = events
 
 # Initial load
 load_random_events()
 
+def read_chapter(chapter_name):
+    path = os.path.join(CHAPTERS_DIR, f"{chapter_name}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
 def load_chapter(chapter_name):
-    if app.debug or chapter_name not in CHAPTER_CACHE:
-        path = os.path.join(CHAPTERS_DIR, f"{chapter_name}.json")
-        if not os.path.exists(path):
+    global CHAPTER_CACHE
+    cached = CHAPTER_CACHE.get(chapter_name)
+    if app.debug or cached is None:
+        data = read_chapter(chapter_name)
+        if data is None:
             return None
-        with open(path, 'r', encoding='utf-8') as f:
-            CHAPTER_CACHE[chapter_name] = json.load(f)
-    return CHAPTER_CACHE[chapter_name]
+        # Cache and index are published together so they always agree;
+        # the index update is a no-op unless the content actually changed
+        with CONTENT_LOCK:
+            if CHAPTER_CACHE.get(chapter_name) != data:
+                CHAPTER_CACHE = {**CHAPTER_CACHE, chapter_name: data}
+            PROGRESS_INDEX.update_chapter(chapter_name, data)
+        return data
+    return cached
+
+def load_progress_index():
+    # Runs at import, so a bad file must not take the whole app down
+    global CHAPTER_CACHE
+    chapters = {}
+    if not os.path.isdir(CHAPTERS_DIR):
+        app.logger.error('Chapters directory %s not found, progress index is empty', CHAPTERS_DIR)
+        filenames = []
+    else:
+        filenames = sorted(os.listdir(CHAPTERS_DIR))
+
+    for filename in filenames:
+        if filename.endswith('.json'):
+            chapter_name = filename[:-5]
+            try:
+                data = read_chapter(chapter_name)
+            except (OSError, json.JSONDecodeError) as e:
+                app.logger.error('Skipping chapter %s: %s', filename, e)
+                continue
+            if data is not None:
+                chapters[chapter_name] = data
+    with CONTENT_LOCK:
+        CHAPTER_CACHE = chapters
+        PROGRESS_INDEX.load(chapters)
+
+# Distance-to-ending index over the whole chapter graph, built at load time
+load_progress_index()
 
 @app.route('/')
 def index():
@@ -49,6 +116,12 @@ def start_game():
     session.clear()
     load_random_events()
 
+    sid = os.urandom(8).hex()
+    session['sid'] = sid
+    session['turn'] = 0
+    session['worker'] = WORKER_ID
+    SESSIONS.create(sid)
+
     # Default start: chapter01_arrival
     initial_chapter = 'chapter01_arrival'
     story_data = load_chapter(initial_chapter)
@@ -74,10 +147,43 @@ def start_game():
     session['mode'] = 'story'
 
     node_data = story_data['nodes'][start_node]
-    return jsonify(get_response_payload(node_data))
+    return jsonify(get_response_payload(node_data, prefetch_chapter=initial_chapter))
 
 @app.route('/choice', methods=['POST'])
 def make_choice():
+    # Choices from one player are handled one at a time. The cookie's turn
+    # number must match the last accepted turn, so a request sent with a
+    # stale cookie (e.g. a double-click) is rejected instead of replaying
+    # the transition from an outdated state.
+    sid = session.get('sid')
+    if not sid:
+        if not session.get('current_chapter'):
+            return jsonify({'error': 'Game not started'}), 400
+        # Session started before turn tracking existed
+        sid = session['sid'] = os.urandom(8).hex()
+
+    if session.get('worker') != WORKER_ID:
+        # Live Mode history only exists in the process that started it
+        if session.get('mode') == 'live':
+            return jsonify({'error': 'Live session expired'}), 421
+        session['worker'] = WORKER_ID
+
+    turn = session.get('turn', 0)
+    record = SESSIONS.record(sid, turn)
+    with record.lock:
+        if turn < record.turn:
+            return jsonify({'error': 'Stale choice', 'turn': record.turn}), 409
+
+        response = app.make_response(process_choice())
+        if response.status_code == 200:
+            # Always retire the old turn, even when a reset replaced the sid,
+            # so a duplicate of the same request is still rejected
+            record.turn = turn + 1
+            if session.get('sid') == sid:
+                session['turn'] = turn + 1
+        return response
+
+def process_choice():
     # Detect Mode
     if session.get('mode') == 'live':
         return make_live_choice()
@@ -200,37 +306,19 @@ def make_choice():
         if effects.get('reset'):
             return start_game()
 
-        session['sanity'] = session.get('sanity', 100) + effects.get('sanity', 0)
-        if 'add_item' in effects:
-            inv = session.get('inventory', [])
-            items_to_add = effects['add_item']
-
-            # Handle both single string and list of strings
-            if isinstance(items_to_add, list):
-                for item in items_to_add:
-                    if item not in inv:
-                        inv.append(item)
-            else:
-                if items_to_add not in inv:
-                    inv.append(items_to_add)
-
-            session['inventory'] = inv
-
-        if 'update_stats' in effects:
-            stats = session.get('stats', {})
-            for k, v in effects['update_stats'].items():
-                stats[k] = stats.get(k, 10) + v
-            session['stats'] = stats
+        apply_effects(effects)
 
     # Handle Transition
 
     # Handle Random Events (Interruption)
     # 15% chance, only if not switching chapters (to keep simple) and not a special node
+    # Events never chain: resuming from one must not overwrite pending_destination
     triggered_event = None
-    if not next_chapter and RANDOM_EVENTS and random.random() < 0.15:
+    events = RANDOM_EVENTS
+    if not next_chapter and events and current_node_id != 'RANDOM_EVENT_Active' and random.random() < 0.15:
         # Don't trigger if the current choice specifically avoids it (optional flag)
         # Pick a random event
-        event = random.choice(RANDOM_EVENTS)
+        event = random.choice(events)
         triggered_event = event
         # We don't change session['current_node'] permanently yet,
         # but we serve the event node. The event node MUST have a choice to "Continue"
@@ -298,6 +386,8 @@ def make_choice():
         session['pending_destination'] = next_node_id
         session['pending_chapter'] = next_chapter if next_chapter else session.get('current_chapter')
         session['current_node'] = 'RANDOM_EVENT_Active'
+        # Kept so /state can show the event again
+        session['active_event'] = {'text': triggered_event['text'], 'visual': triggered_event['visual']}
 
         next_node = {
             "text": triggered_event['text'],
@@ -358,11 +448,123 @@ def make_choice():
     if not next_node:
          return jsonify({'error': f'Node {next_node_id} not found'}), 500
 
-    payload = get_response_payload(next_node)
+    # The random event node is virtual, its only successor is the pending destination
+    prefetch_chapter = None
+    if session.get('current_node') != 'RANDOM_EVENT_Active':
+        prefetch_chapter = session.get('current_chapter')
+
+    payload = get_response_payload(next_node, prefetch_chapter=prefetch_chapter)
     if roll_message:
         payload['roll_message'] = roll_message
     return jsonify(payload)
 
+@app.route('/state')
+def current_state():
+    # The screen the server considers current, for clients that lost track
+    # of it (e.g. a choice rejected because another tab moved on)
+    if session.get('mode') == 'live':
+        record = SESSIONS.get(session.get('sid')) if session.get('worker') == WORKER_ID else None
+        if not record or not record.history:
+            return jsonify({'error': 'Live session expired'}), 421
+        last_msg = next((m for m in reversed(record.history) if m['role'] == 'assistant'), None)
+        if not last_msg:
+            return jsonify({'error': 'Nothing to resume'}), 404
+        return jsonify(get_response_payload(json.loads(last_msg['content'])))
+
+    chapter = session.get('current_chapter')
+    node_id = session.get('current_node')
+    if not chapter or not node_id:
+        return jsonify({'error': 'Game not started'}), 400
+
+    if node_id == 'RANDOM_EVENT_Active':
+        event = session.get('active_event', {})
+        node = {
+            "text": event.get('text', ''),
+            "visual": event.get('visual', '⚠️'),
+            "choices": [{"text": "继续", "next_node": "RESUME_JOURNEY"}]
+        }
+        return jsonify(get_response_payload(node))
+
+    story_data = load_chapter(chapter)
+    node = story_data['nodes'].get(node_id) if story_data else None
+    if not node:
+        return jsonify({'error': f'Node {node_id} not found'}), 500
+    return jsonify(get_response_payload(node, prefetch_chapter=chapter))
+
+@app.route('/progress')
+def progress():
+    if session.get('mode') != 'story':
+        return jsonify({'error': 'Progress is only tracked in story mode'}), 400
+
+    chapter = session.get('current_chapter')
+    node_id = session.get('current_node')
+    if not chapter or not node_id:
+        return jsonify({'error': 'Game not started'}), 400
+
+    in_event = node_id == 'RANDOM_EVENT_Active'
+    if in_event:
+        # Report progress for where the player resumes after the event
+        chapter = session.get('pending_chapter')
+        node_id = session.get('pending_destination')
+
+    # Distances only use choices the player's current state unlocks, so every
+    # step count is achievable through visible choices (with favourable rolls).
+    # Items picked up along the way are not assumed.
+    table = PROGRESS_INDEX.table(check_condition)
+
+    # A pending random destination is measured by its closest candidate
+    candidates = node_id if isinstance(node_id, list) else [node_id]
+    info = None
+    for candidate in candidates:
+        found = PROGRESS_INDEX.lookup(chapter, candidate, table)
+        if found and (info is None or found['steps_remaining'] < info['steps_remaining']):
+            info = found
+
+    if in_event and info:
+        # Clicking through the event is one more step
+        info = {
+            'nearest_ending': info['nearest_ending'],
+            'steps_remaining': info['steps_remaining'] + 1,
+            'endings': {k: v + 1 for k, v in info['endings'].items()}
+        }
+
+    # Hint: the visible choice that leads closest to an ending
+    hint = None
+    story_data = load_chapter(chapter)
+    node = story_data['nodes'].get(node_id) if story_data and not in_event else None
+    if in_event and info:
+        # The event's only choice resumes the journey
+        hint = {'index': 0, 'text': '继续', 'steps_remaining': info['steps_remaining']}
+    elif node and info and info['steps_remaining'] > 0:
+        valid = [ch for ch in node.get('choices', []) if check_condition(ch.get('condition'))]
+        for index, ch in enumerate(valid):
+            d = PROGRESS_INDEX.choice_distance(chapter, ch, table)
+            if d is not None and (hint is None or d < hint['steps_remaining']):
+                hint = {'index': index, 'text': ch['text'], 'steps_remaining': d}
+
+    return jsonify({
+        'nearest_ending': info['nearest_ending'] if info else None,
+        'steps_remaining': info['steps_remaining'] if info else None,
+        'endings': info['endings'] if info else {},
+        'hint': hint
+    })
+
+@app.after_request
+def set_worker_cookie(response):
+    # Readable by a sticky-routing proxy, unlike the signed session cookie
+    worker = session.get('worker')
+    if worker and request.cookies.get('worker') != worker:
+        response.set_cookie('worker', worker, httponly=True, samesite='Lax')
+    return response
+
+@app.after_request
+def count_story_bytes(response):
+    # Actual body bytes of story responses, prefetch bundle and sizes included
+    if request.endpoint in ('start_game', 'make_choice', 'current_state') and session.get('mode') == 'story':
+        with PREFETCH_STATS_LOCK:
+            PREFETCH_STATS['response_bytes'] += response.calculate_content_length() or 0
+    return response
+
 @app.errorhandler(500)
 def internal_error(error):
     app.logger.error('Server Error: %s', error)
@@ -373,13 +575,111 @@ def bad_request(error):
     app.logger.error('Bad Request: %s', error)
     return jsonify({'error': 'Bad Request', 'details': str(error)}), 400
 
-def get_response_payload(node):
+@app.route('/prefetch/stats')
+def prefetch_stats():
+    with PREFETCH_STATS_LOCK:
+        return jsonify(dict(PREFETCH_STATS))
+
+def apply_effects(effects, state=None):
+    # state defaults to the player's session; prefetch passes a scratch copy
+    if state is None:
+        state = session
+
+    state['sanity'] = state.get('sanity', 100) + effects.get('sanity', 0)
+    if 'add_item' in effects:
+        inv = state.get('inventory', [])
+        items_to_add = effects['add_item']
+
+        # Handle both single string and list of strings
+        if isinstance(items_to_add, list):
+            for item in items_to_add:
+                if item not in inv:
+                    inv.append(item)
+        else:
+            if items_to_add not in inv:
+                inv.append(items_to_add)
+
+        state['inventory'] = inv
+
+    if 'update_stats' in effects:
+        stats = state.get('stats', {})
+        for k, v in effects['update_stats'].items():
+            stats[k] = stats.get(k, 10) + v
+        state['stats'] = stats
+
+def copy_state(state):
+    return {
+        'sanity': state.get('sanity'),
+        'inventory': list(state.get('inventory') or []),
+        'stats': dict(state.get('stats', {}))
+    }
+
+def deterministic_successor(chapter_name, choice):
+    # Returns the node a choice always leads to, or None if the outcome
+    # involves a roll, a reset, a random target or variable text.
+    if 'roll' in choice or choice.get('effect', {}).get('reset'):
+        return None
+
+    next_chapter = choice.get('next_chapter')
+    next_node_id = choice.get('next_node')
+    story_data = load_chapter(next_chapter or chapter_name)
+    if not story_data:
+        return None
+
+    if next_chapter and not next_node_id:
+        next_node_id = story_data['start_node']
+    if not isinstance(next_node_id, str):
+        return None
+
+    node = story_data['nodes'].get(next_node_id)
+    if not node or isinstance(node.get('text'), list):
+        return None
+    return node
+
+def build_prefetch(chapter_name, node, state):
+    # Keyed by the client-facing choice index (position among valid choices).
+    # Sizes are each entry's compact JSON length, which is what it adds to a
+    # jsonify body outside debug mode (debug pretty-prints, so sizes there are
+    # an approximation). The real per-response total is in PREFETCH_STATS.
+    bundle = {}
+    sizes = {}
+    bundled_bytes = 0
+    valid = [ch for ch in node['choices'] if check_condition(ch.get('condition'), state)]
+
+    for index, ch in enumerate(valid):
+        if len(bundle) >= PREFETCH_MAX_NODES:
+            break
+
+        successor = deterministic_successor(chapter_name, ch)
+        if successor is None:
+            continue
+
+        next_state = copy_state(state)
+        apply_effects(ch.get('effect', {}), next_state)
+
+        entry = get_response_payload(successor, state=next_state)
+        size = len(app.json.dumps(entry, separators=(',', ':')))
+        if bundled_bytes + size > PREFETCH_MAX_BYTES:
+            with PREFETCH_STATS_LOCK:
+                PREFETCH_STATS['skipped_over_limit'] += 1
+            continue
+
+        bundle[str(index)] = entry
+        sizes[str(index)] = size
+        bundled_bytes += size
+
+    return bundle, sizes
+
+def get_response_payload(node, state=None, prefetch_chapter=None):
+    if state is None:
+        state = session
+
     valid_choices = []
     # If node has 'choices' list of strings (Live Mode) vs objects (Story Mode)
     # We adapt here or handle it in live logic.
     if node.get('choices') and isinstance(node['choices'][0], dict):
         for ch in node['choices']:
-            if check_condition(ch.get('condition')):
+            if check_condition(ch.get('condition'), state):
                 valid_choices.append({'text': ch['text'], 'index': len(valid_choices)})
     elif node.get('choices'):
          # List of strings (from LLM)
@@ -391,22 +691,38 @@ def get_response_payload(node):
     if isinstance(text_content, list):
         text_content = random.choice(text_content)
 
-    return {
+    payload = {
         'text': text_content,
         'visual': node.get('visual', ''),
         'choices': valid_choices,
         'stats': {
-            'sanity': session.get('sanity'),
-            'inventory': session.get('inventory'),
-            'attributes': session.get('stats', {})
+            'sanity': state.get('sanity'),
+            'inventory': state.get('inventory'),
+            'attributes': state.get('stats', {})
         }
     }
 
-def check_condition(condition):
+    if prefetch_chapter and PREFETCH_ENABLED and valid_choices:
+        bundle, sizes = build_prefetch(prefetch_chapter, node, state)
+        bundled_bytes = sum(sizes.values())
+        if bundle:
+            payload['prefetch'] = bundle
+            payload['prefetch_sizes'] = sizes
+            payload['prefetch_bytes'] = bundled_bytes
+        with PREFETCH_STATS_LOCK:
+            PREFETCH_STATS['responses'] += 1
+            PREFETCH_STATS['bundled_nodes'] += len(bundle)
+            PREFETCH_STATS['bundled_bytes'] += bundled_bytes
+
+    return payload
+
+def check_condition(condition, state=None):
     if not condition: return True
+    if state is None:
+        state = session
     if 'has_item' in condition:
         item = condition['has_item']
-        inv = session.get('inventory', [])
+        inv = state.get('inventory', [])
         # Support list of items (all required)
         if isinstance(item, list):
             for i in item:
@@ -416,10 +732,10 @@ def check_condition(condition):
         elif item not in inv:
             return False
     if 'min_sanity' in condition:
-        if session.get('sanity', 0) < condition['min_sanity']:
+        if state.get('sanity', 0) < condition['min_sanity']:
             return False
     if 'max_sanity' in condition:
-        if session.get('sanity', 0) > condition['max_sanity']:
+        if state.get('sanity', 0) > condition['max_sanity']:
             return False
     return True
 
@@ -442,19 +758,23 @@ def live_setup():
 
     # Init session history
     sid = os.urandom(8).hex()
-    session['live_sid'] = sid
-    LIVE_SESSIONS[sid] = []
+    session['sid'] = sid
+    session['turn'] = 0
+    session['worker'] = WORKER_ID
+    record = SESSIONS.create(sid)
 
     # Generate intro
-    return generate_live_turn("GAME_START")
+    with record.lock:
+        return generate_live_turn("GAME_START")
 
 def make_live_choice():
+    # Called from make_choice with the session's record lock held
     choice_index = request.json.get('index')
-    sid = session.get('live_sid')
-    if not sid or sid not in LIVE_SESSIONS:
-        return jsonify({'error': 'Live session expired'}), 400
+    record = SESSIONS.get(session.get('sid'))
+    if not record or not record.history:
+        return jsonify({'error': 'Live session expired'}), 421
 
-    history = LIVE_SESSIONS[sid]
+    history = record.history
     # Get last assistant message to find choices
     last_msg = next((m for m in reversed(history) if m['role'] == 'assistant'), None)
 
@@ -471,8 +791,7 @@ def make_live_choice():
     return generate_live_turn(user_action)
 
 def generate_live_turn(user_input):
-    sid = session.get('live_sid')
-    history = LIVE_SESSIONS[sid]
+    history = SESSIONS.get(session.get('sid')).history
 
     # Construct System Prompt if new
     if not history:
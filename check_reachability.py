@@ -24,6 +24,73 @@ def load_all_chapters():
                     print(f"Error decoding {filename}: {e}")
     return chapters
 
+# Endings the story must be able to reach, all located in the final chapter
+ENDINGS_CHAPTER = 'chapter20_lighthouse_top'
+EXPECTED_ENDINGS = [
+    'end_scholar', 'end_hero', 'end_cult_leader',
+    'end_sacrifice', 'end_shoot_crystal', 'end_bad'
+]
+
+def print_warning(message):
+    print(f"WARNING: {message}")
+
+def choice_targets(chap_name, choice, chapters, source=None, warn=print_warning):
+    # Returns every (chapter_id, node_id) a single choice can lead to.
+    # `source` is only used to locate warnings; `warn` receives them
+    # (the app passes its logger instead of printing).
+    targets = []
+
+    # 1. Check Explicit Transitions
+    next_chap = choice.get('next_chapter')
+    next_node = choice.get('next_node')
+
+    # If it's a Roll, we look at success/failure nodes instead of 'next_node' (which is often 'dummy')
+    roll_targets = []
+    if 'roll' in choice:
+        roll = choice['roll']
+        if 'success_node' in roll:
+            roll_targets.append(roll['success_node'])
+        if 'failure_node' in roll:
+            roll_targets.append(roll['failure_node'])
+
+    # Determine targets
+    target_definitions = []
+
+    # If roll exists, we use roll targets within the SAME chapter (usually)
+    if roll_targets:
+        for t in roll_targets:
+            target_definitions.append( (None, t) ) # None means same chapter
+    else:
+        # Standard link
+        target_definitions.append( (next_chap, next_node) )
+
+    for t_chap, t_node in target_definitions:
+        final_chap = t_chap if t_chap else chap_name
+
+        # Resolve Start Node if node is missing/None
+        if final_chap != chap_name and not t_node:
+            # Link to start of new chapter
+            if final_chap not in chapters:
+                warn(f"Link to missing chapter '{final_chap}' from {source or chap_name}")
+                continue
+
+            starts = chapters[final_chap].get('start_node')
+            if isinstance(starts, list):
+                for s in starts:
+                    targets.append( (final_chap, s) )
+            else:
+                targets.append( (final_chap, starts) )
+
+        elif t_node and t_node != 'dummy':
+            # Specific node
+            if isinstance(t_node, list):
+                for n in t_node:
+                    targets.append( (final_chap, n) )
+            else:
+                targets.append( (final_chap, t_node) )
+
+    return targets
+
 def build_graph(chapters):
     # Graph: key = (chapter_id, node_id), value = list of (next_chapter_id, next_node_id)
     adj = collections.defaultdict(list)
@@ -35,54 +102,7 @@ def build_graph(chapters):
             choices = node_data.get('choices', [])
 
             for choice in choices:
-                # 1. Check Explicit Transitions
-                next_chap = choice.get('next_chapter')
-                next_node = choice.get('next_node')
-
-                # If it's a Roll, we look at success/failure nodes instead of 'next_node' (which is often 'dummy')
-                roll_targets = []
-                if 'roll' in choice:
-                    roll = choice['roll']
-                    if 'success_node' in roll:
-                        roll_targets.append(roll['success_node'])
-                    if 'failure_node' in roll:
-                        roll_targets.append(roll['failure_node'])
-
-                # Determine targets
-                target_definitions = []
-
-                # If roll exists, we use roll targets within the SAME chapter (usually)
-                if roll_targets:
-                    for t in roll_targets:
-                        target_definitions.append( (None, t) ) # None means same chapter
-                else:
-                    # Standard link
-                    target_definitions.append( (next_chap, next_node) )
-
-                for t_chap, t_node in target_definitions:
-                    final_chap = t_chap if t_chap else chap_name
-
-                    # Resolve Start Node if node is missing/None
-                    if final_chap != chap_name and not t_node:
-                        # Link to start of new chapter
-                        if final_chap not in chapters:
-                            print(f"WARNING: Link to missing chapter '{final_chap}' from {current}")
-                            continue
-
-                        starts = chapters[final_chap].get('start_node')
-                        if isinstance(starts, list):
-                            for s in starts:
-                                adj[current].append( (final_chap, s) )
-                        else:
-                            adj[current].append( (final_chap, starts) )
-
-                    elif t_node and t_node != 'dummy':
-                        # Specific node
-                        if isinstance(t_node, list):
-                            for n in t_node:
-                                adj[current].append( (final_chap, n) )
-                        else:
-                            adj[current].append( (final_chap, t_node) )
+                adj[current].extend(choice_targets(chap_name, choice, chapters, current))
 
     return adj
 
@@ -123,11 +143,8 @@ def check_reachability():
                 visited.add(neighbor)
                 queue.append(neighbor)
 
-    expected_endings = [
-        'end_scholar', 'end_hero', 'end_cult_leader',
-        'end_sacrifice', 'end_shoot_crystal', 'end_bad'
-    ]
-    target_chap = 'chapter20_lighthouse_top'
+    expected_endings = EXPECTED_ENDINGS
+    target_chap = ENDINGS_CHAPTER
 
     print("\n--- Reachability Report ---")
     all_ok = True
@@ -0,0 +1,216 @@
+import collections
+import json
+import threading
+from array import array
+
+from check_reachability import choice_targets, print_warning, ENDINGS_CHAPTER, EXPECTED_ENDINGS
+
+# Precomputed distance-to-ending index for the running game.
+# Every (chapter, node) is interned to a small integer, and the reverse
+# shortest-path distance from each node to each ending is stored in flat
+# int arrays indexed by that integer.
+#
+# Choices gated by a `condition` only count as edges when the player's state
+# satisfies that condition, so distances depend on the set of satisfied
+# conditions. This is a deliberate departure from a single table precomputed
+# at load time: one table that ignores conditions reports step counts that
+# only hidden choices can achieve. The tables for "no condition met" (a fresh
+# game) and "every condition met" are built with the index; tables for other
+# sets are built on first use and kept in a bounded LRU cache. A lookup is
+# then a cache hit plus an array read. Rolls and random targets count as
+# their best outcome.
+#
+# Rebuilds run under a lock and publish the graph as one tuple, so readers
+# never need the lock and always see a consistent set.
+
+UNREACHABLE = -1
+UNCONDITIONAL = -1
+MAX_CACHED_TABLES = 64  # Per-state tables kept besides the two prebuilt ones
+
+class ProgressIndex:
+    def __init__(self, endings_chapter=ENDINGS_CHAPTER, endings=EXPECTED_ENDINGS, warn=print_warning):
+        self.endings = [(endings_chapter, e) for e in endings]
+        # Receives warnings about broken links
+        self.warn = warn
+
+        # Interning: (chapter, node) <-> int id
+        self.ids = {}
+        self.keys = []
+        # Interning of distinct choice conditions
+        self.condition_ids = {}
+        self.conditions = []
+
+        self.chapters = {}
+        # chapter -> {node id: [(successor id, condition id)]}, rebuilt one chapter at a time
+        self.out_edges = {}
+        # chapter -> chapters whose choices point into it (their edges depend on its start_node)
+        self.dependents = collections.defaultdict(set)
+
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+
+        # (reverse edges, conditions, prebuilt tables, LRU of other tables),
+        # tables keyed by the frozenset of satisfied condition ids
+        self.snapshot = ([], (), {}, collections.OrderedDict())
+
+    def intern(self, key):
+        node_id = self.ids.get(key)
+        if node_id is None:
+            node_id = len(self.keys)
+            self.ids[key] = node_id
+            self.keys.append(key)
+        return node_id
+
+    def intern_condition(self, condition):
+        if not condition:
+            return UNCONDITIONAL
+        key = json.dumps(condition, sort_keys=True)
+        cond_id = self.condition_ids.get(key)
+        if cond_id is None:
+            cond_id = len(self.conditions)
+            self.condition_ids[key] = cond_id
+            self.conditions.append(condition)
+        return cond_id
+
+    def load(self, chapters):
+        # Full build, used at startup
+        with self._lock:
+            self.chapters = dict(chapters)
+            self.out_edges = {}
+            self.dependents.clear()
+            for chap_name in self.chapters:
+                self._rebuild_edges(chap_name)
+            self._publish()
+
+    def update_chapter(self, chap_name, data):
+        # Incremental rebuild: only the changed chapter's edges and the edges of
+        # chapters that link into it are regenerated. Returns True if anything changed.
+        if self.chapters.get(chap_name) == data:
+            return False
+
+        with self._lock:
+            if self.chapters.get(chap_name) == data:
+                return False
+            # Copy-on-write so choice_distance can read chapters without the lock
+            self.chapters = {**self.chapters, chap_name: data}
+            for name in {chap_name} | self.dependents[chap_name]:
+                if name in self.chapters:
+                    self._rebuild_edges(name)
+            self._publish()
+        return True
+
+    def _rebuild_edges(self, chap_name):
+        edges = {}
+        nodes = self.chapters[chap_name].get('nodes', {})
+        for node_id, node_data in nodes.items():
+            src = self.intern((chap_name, node_id))
+            successors = []
+            for choice in node_data.get('choices', []):
+                if choice.get('next_chapter'):
+                    self.dependents[choice['next_chapter']].add(chap_name)
+                cond_id = self.intern_condition(choice.get('condition'))
+                for target in choice_targets(chap_name, choice, self.chapters, (chap_name, node_id), self.warn):
+                    successors.append((self.intern(target), cond_id))
+            edges[src] = successors
+        self.out_edges[chap_name] = edges
+
+    def _publish(self):
+        reverse = [[] for _ in range(len(self.keys))]
+        for edges in self.out_edges.values():
+            for src, successors in edges.items():
+                for dst, cond_id in successors:
+                    reverse[dst].append((src, cond_id))
+
+        conditions = tuple(self.conditions)
+        none_met = frozenset()
+        all_met = frozenset(range(len(conditions)))
+        prebuilt = {
+            none_met: self._distances(reverse, none_met),
+            all_met: self._distances(reverse, all_met)
+        }
+        self.snapshot = (reverse, conditions, prebuilt, collections.OrderedDict())
+
+    def _distances(self, reverse, usable):
+        # Reverse BFS from each ending over the edges whose condition is usable
+        size = len(reverse)
+        dist_to = []
+        for ending in self.endings:
+            dist = array('i', [UNREACHABLE]) * size
+            start = self.ids.get(ending)
+            if start is not None and start < size:
+                dist[start] = 0
+                queue = collections.deque([start])
+                while queue:
+                    curr = queue.popleft()
+                    for prev, cond_id in reverse[curr]:
+                        if dist[prev] == UNREACHABLE and (cond_id == UNCONDITIONAL or cond_id in usable):
+                            dist[prev] = dist[curr] + 1
+                            queue.append(prev)
+            dist_to.append(dist)
+
+        nearest_dist = array('i', [UNREACHABLE]) * size
+        nearest = array('i', [UNREACHABLE]) * size
+        for k, dist in enumerate(dist_to):
+            for i in range(size):
+                d = dist[i]
+                if d != UNREACHABLE and (nearest_dist[i] == UNREACHABLE or d < nearest_dist[i]):
+                    nearest_dist[i] = d
+                    nearest[i] = k
+
+        return (dist_to, nearest_dist, nearest)
+
+    def table(self, check=None):
+        # Distance table for a player state. `check(condition)` tells whether the
+        # state satisfies a condition; without it every condition counts as met.
+        reverse, conditions, prebuilt, cache = self.snapshot
+        usable = frozenset(i for i, cond in enumerate(conditions) if check is None or check(cond))
+        table = prebuilt.get(usable)
+        if table is not None:
+            return table
+
+        with self._cache_lock:
+            table = cache.get(usable)
+            if table is not None:
+                cache.move_to_end(usable)
+                return table
+
+        # Built outside the lock; two threads may both build it, which is harmless
+        table = self._distances(reverse, usable)
+        with self._cache_lock:
+            cache[usable] = table
+            cache.move_to_end(usable)
+            while len(cache) > MAX_CACHED_TABLES:
+                cache.popitem(last=False)
+        return table
+
+    def distance(self, chap_name, node_id, table):
+        # Steps to the nearest ending, or None if no ending can be reached
+        dist = table[1]
+        i = self.ids.get((chap_name, node_id))
+        if i is None or i >= len(dist) or dist[i] == UNREACHABLE:
+            return None
+        return dist[i]
+
+    def lookup(self, chap_name, node_id, table):
+        dist_to, dist, nearest = table
+        i = self.ids.get((chap_name, node_id))
+        if i is None or i >= len(dist) or dist[i] == UNREACHABLE:
+            return None
+        return {
+            'nearest_ending': self.endings[nearest[i]][1],
+            'steps_remaining': dist[i],
+            'endings': {
+                ending[1]: dist_to[k][i]
+                for k, ending in enumerate(self.endings)
+                if dist_to[k][i] != UNREACHABLE
+            }
+        }
+
+    def choice_distance(self, chap_name, choice, table):
+        # Best-case steps to an ending after taking `choice` (counting the choice itself)
+        best = None
+        for t_chap, t_node in choice_targets(chap_name, choice, self.chapters, warn=self.warn):
+            d = self.distance(t_chap, t_node, table)
+            if d is not None and (best is None or d + 1 < best):
+                best = d + 1
+        return best
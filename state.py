@@ -0,0 +1,62 @@
+import threading
+import time
+
+# Server-side per-session state shared by request threads.
+# Records live in a fixed number of shards, each guarded by its own lock, so
+# threads serving different players rarely contend. Each record carries a
+# second lock that serializes requests from the same player.
+# The store is per process; app.py binds Live Mode sessions to one worker.
+
+SESSION_TTL = 6 * 60 * 60  # Seconds before an idle record is dropped
+
+class SessionRecord:
+    __slots__ = ('lock', 'turn', 'history', 'touched')
+
+    def __init__(self, turn=0):
+        self.lock = threading.Lock()
+        # Number of the last /choice accepted for this session
+        self.turn = turn
+        # Live Mode message history
+        self.history = []
+        self.touched = time.monotonic()
+
+class SessionStore:
+    def __init__(self, shards=16, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+
+    def _shard(self, sid):
+        return self._shards[hash(sid) % len(self._shards)]
+
+    def get(self, sid):
+        lock, records = self._shard(sid)
+        with lock:
+            record = records.get(sid)
+            if record:
+                record.touched = time.monotonic()
+            return record
+
+    def record(self, sid, turn=0):
+        # Get or create; a record unknown to this process (restart, another
+        # worker) starts at the turn the client's cookie claims.
+        lock, records = self._shard(sid)
+        with lock:
+            record = records.get(sid)
+            if record is None:
+                self._prune(records)
+                record = records[sid] = SessionRecord(turn)
+            record.touched = time.monotonic()
+            return record
+
+    def create(self, sid):
+        lock, records = self._shard(sid)
+        with lock:
+            self._prune(records)
+            record = records[sid] = SessionRecord()
+            return record
+
+    def _prune(self, records):
+        # Caller holds the shard lock
+        cutoff = time.monotonic() - self.ttl
+        for sid in [s for s, r in records.items() if r.touched < cutoff]:
+            del records[sid]
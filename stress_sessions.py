@@ -0,0 +1,137 @@
+import threading
+
+from app import app, SESSIONS, load_chapter
+from check_reachability import ENDINGS_CHAPTER, EXPECTED_ENDINGS
+
+# Utility script to check that concurrent requests from one player keep the
+# session consistent. Every round fires the same /choice from many threads
+# carrying the same session cookie (a burst of double-clicks); exactly one
+# must be accepted, the rest rejected as stale, and the accepted state must
+# be a valid transition.
+
+THREADS = 16
+ROUNDS = 40
+
+def fire(cookie, index):
+    # Sends `index` from THREADS clients at once, returns [(status, json, cookie)]
+    results = [None] * THREADS
+    barrier = threading.Barrier(THREADS)
+
+    def worker(slot):
+        client = app.test_client()
+        client.set_cookie('session', cookie)
+        barrier.wait()
+        r = client.post('/choice', json={'index': index})
+        new_cookie = client.get_cookie('session')
+        results[slot] = (r.status_code, r.get_json(), new_cookie.value if new_cookie else cookie)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(THREADS)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return results
+
+def read_session(cookie):
+    client = app.test_client()
+    client.set_cookie('session', cookie)
+    with client.session_transaction() as s:
+        return dict(s)
+
+def check_state(state):
+    # The cookie must point at a real node, or at a random event whose
+    # pending destination is a real node
+    chapter = state.get('current_chapter')
+    node = state.get('current_node')
+    if node == 'RANDOM_EVENT_Active':
+        chapter = state.get('pending_chapter')
+        node = state.get('pending_destination')
+        if isinstance(node, list):
+            return all(n in load_chapter(chapter)['nodes'] for n in node)
+    data = load_chapter(chapter)
+    return bool(data) and node in data['nodes']
+
+def stress_story():
+    client = app.test_client()
+    client.post('/start')
+    cookie = client.get_cookie('session').value
+
+    problems = []
+    for round_no in range(ROUNDS):
+        before = read_session(cookie)
+        results = fire(cookie, 0)
+
+        accepted = [r for r in results if r[0] == 200]
+        stale = [r for r in results if r[0] == 409]
+        if len(accepted) != 1 or len(stale) != THREADS - 1:
+            problems.append(f"round {round_no}: {len(accepted)} accepted, {len(stale)} stale, "
+                            f"others {[r[0] for r in results if r[0] not in (200, 409)]}")
+            break
+
+        cookie = accepted[0][2]
+        after = read_session(cookie)
+        if after.get('sid') == before.get('sid') and after.get('turn') != before.get('turn', 0) + 1:
+            problems.append(f"round {round_no}: turn {before.get('turn')} -> {after.get('turn')}")
+        if after.get('sid') == before.get('sid') and SESSIONS.get(after['sid']).turn != after['turn']:
+            problems.append(f"round {round_no}: server turn out of sync")
+        if not check_state(after):
+            problems.append(f"round {round_no}: invalid state {after.get('current_chapter')}/{after.get('current_node')}")
+        if not accepted[0][1].get('choices'):
+            break
+
+    return problems
+
+def stress_reset():
+    # Ending nodes restart the game through an 'effect.reset' choice, which
+    # replaces the session id; duplicates must still be rejected
+    client = app.test_client()
+    client.post('/start')
+    with client.session_transaction() as s:
+        s['current_chapter'] = ENDINGS_CHAPTER
+        s['current_node'] = EXPECTED_ENDINGS[0]
+    cookie = client.get_cookie('session').value
+    before = read_session(cookie)
+
+    problems = []
+    results = fire(cookie, 0)
+    accepted = [r for r in results if r[0] == 200]
+    if len(accepted) != 1:
+        problems.append(f"reset: {len(accepted)} accepted")
+        return problems
+
+    after = read_session(accepted[0][2])
+    if after.get('sid') == before.get('sid') or after.get('turn') != 0:
+        problems.append(f"reset: new game not started (turn {after.get('turn')})")
+    if not check_state(after):
+        problems.append(f"reset: invalid state {after.get('current_chapter')}/{after.get('current_node')}")
+
+    return problems
+
+def stress_live():
+    # Mock mode (no API key); each accepted turn appends exactly one user message
+    client = app.test_client()
+    client.post('/live/setup', json={'world_prompt': 'stress'})
+    cookie = client.get_cookie('session').value
+    sid = read_session(cookie)['sid']
+
+    problems = []
+    for round_no in range(3):
+        before = len(SESSIONS.get(sid).history)
+        results = fire(cookie, 0)
+        accepted = [r for r in results if r[0] == 200]
+        if len(accepted) != 1:
+            problems.append(f"live round {round_no}: {len(accepted)} accepted")
+            break
+        cookie = accepted[0][2]
+        if len(SESSIONS.get(sid).history) != before + 1:
+            problems.append(f"live round {round_no}: history grew by {len(SESSIONS.get(sid).history) - before}")
+
+    return problems
+
+if __name__ == "__main__":
+    problems = stress_story() + stress_reset() + stress_live()
+
+    print("\n--- Session Stress Report ---")
+    for p in problems:
+        print(f"[FAIL] {p}")
+
+    if not problems: print(f"\nCONSISTENT ({THREADS} threads x {ROUNDS} rounds).")
+    else: print("\nINCONSISTENT STATE DETECTED.")